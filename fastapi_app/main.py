@@ -1,25 +1,195 @@
-import json
+import asyncio
+import atexit
+import gzip
+import tempfile
+import orjson
 import time
-import requests
 from concurrent.futures import ThreadPoolExecutor
 from typing import List, Dict
 from fastapi import FastAPI, HTTPException
-from pydantic import BaseModel
+from fastapi.responses import ORJSONResponse
+from pydantic import BaseModel, field_validator
 from dotenv import load_dotenv
 import boto3
-from lambdas.bitget_client import BitgetClient
+import functools
+import logging
+import logging.handlers
+import queue
+import threading
+import zstandard as zstd
+from cachetools import TTLCache
+from boto3.s3.transfer import TransferConfig
+from botocore.config import Config
+from botocore.exceptions import ClientError
+from lambdas.bitget_client import BitgetClient, build_session
 import os
-from typing import List, Optional, Dict, Any
-from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import List, Optional, Dict, Any, Tuple
 from datetime import datetime
+from contextlib import asynccontextmanager
+from collections import defaultdict, deque
+from itertools import islice
+from urllib.parse import urlencode
 
 load_dotenv()
 
-app = FastAPI(title="Bitget Futures Orders Extractor", version="1.0.0")
+# Configuración leída una sola vez al importar el módulo
+BITGET_API_KEY = os.getenv('BITGET_API_KEY')
+BITGET_SECRET_KEY = os.getenv('BITGET_SECRET_KEY')
+BITGET_PASSPHRASE = os.getenv('BITGET_PASSPHRASE')
+AWS_REGION = os.getenv('AWS_REGION', 'us-east-1')
+STATE_MACHINE_ARN = os.getenv(
+    'STATE_MACHINE_ARN',
+    'arn:aws:states:us-east-1:000000000000:stateMachine:BitgetMassiveExtractionStateMachine'
+)
+# /extract solo usa modo local con DEBUG=true; /extract/futures lo usa salvo que DEBUG=false
+DEBUG_MODE = os.getenv('DEBUG', 'false').lower() == 'true'
+FUTURES_LOCAL_MODE = os.getenv('DEBUG', 'true').lower() == 'true'
+# Guardar resultados como NDJSON (una orden por línea) en lugar de un único JSON
+NDJSON_OUTPUT = os.getenv('NDJSON_OUTPUT', '0').lower() in ('1', 'true')
+# Listar el bucket tras cada subida (solo para depurar)
+DEBUG_S3 = os.getenv('DEBUG_S3', 'false').lower() in ('1', 'true')
+# Tamaño a partir del cual los archivos temporales de subida pasan de memoria a disco
+SPOOL_MAX_SIZE = 16 * 1024 * 1024
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Executor por defecto de asyncio.to_thread, donde corren las extracciones bloqueantes
+    loop = asyncio.get_running_loop()
+    loop.set_default_executor(ThreadPoolExecutor(
+        max_workers=int(os.getenv('THREAD_POOL_SIZE', '40')),
+        thread_name_prefix='extract'
+    ))
+    yield
+
+app = FastAPI(title="Bitget Futures Orders Extractor", version="1.0.0",
+              default_response_class=ORJSONResponse, lifespan=lifespan)
+
+# Clientes AWS compartidos: se crean una sola vez y reutilizan su pool de conexiones
+# inject_host_prefix=False: StartSyncExecution añade el prefijo "sync-" al host, que LocalStack no resuelve
+_BOTO_CONFIG = Config(max_pool_connections=50, retries={'mode': 'adaptive'}, inject_host_prefix=False)
+# Subidas grandes a S3 en partes de 8 MB en paralelo
+_TRANSFER_CONFIG = TransferConfig(
+    multipart_threshold=8 * 1024 * 1024,
+    multipart_chunksize=8 * 1024 * 1024,
+    max_concurrency=8
+)
+
+# Log de los hilos de descarga: los workers solo encolan y un único hilo escribe en stdout
+_log_queue = queue.SimpleQueue()
+logger = logging.getLogger('bitget')
+logger.setLevel(logging.INFO)
+logger.propagate = False
+logger.addHandler(logging.handlers.QueueHandler(_log_queue))
+_log_listener = logging.handlers.QueueListener(_log_queue, logging.StreamHandler())
+_log_listener.start()
+atexit.register(_log_listener.stop)
+
+# Extracciones en curso: peticiones idénticas concurrentes comparten la misma tarea
+_inflight: Dict[tuple, asyncio.Task] = {}
+
+# Cache corto por (símbolo, rango) para que ráfagas de peticiones no repitan llamadas a Bitget
+_orders_cache = TTLCache(maxsize=4096, ttl=int(os.getenv('ORDER_CACHE_TTL', '5')))
+_orders_cache_lock = threading.Lock()
+
+# La lista de contratos cambia muy poco: se cachea unos minutos
+_symbols_cache = TTLCache(maxsize=4, ttl=int(os.getenv('SYMBOLS_CACHE_TTL', '300')))
+_symbols_lock = threading.RLock()
+
+# Compresor zstd reutilizable (no es thread-safe, se protege con un lock)
+_ZSTD = zstd.ZstdCompressor(level=3, threads=-1)
+_zstd_lock = threading.Lock()
+
+# Pool compartido para las descargas por símbolo (evita crear hilos en cada petición)
+FETCH_POOL_SIZE = int(os.getenv('BITGET_POOL', '32'))
+_POOL = ThreadPoolExecutor(max_workers=FETCH_POOL_SIZE, thread_name_prefix='bitget')
+atexit.register(_POOL.shutdown)
+
+def _bounded_map(func, items, limit: int):
+    """Like _POOL.map, but keeps at most `limit` of this call's tasks on the shared pool"""
+    items = iter(items)
+    pending = deque(_POOL.submit(func, item) for item in islice(items, max(limit, 1)))
+    while pending:
+        result = pending.popleft().result()
+        # Se encola la siguiente tarea solo cuando termina una: el resto del pool queda libre
+        for item in islice(items, 1):
+            pending.append(_POOL.submit(func, item))
+        yield result
+
+# Ventanas de tiempo por símbolo en extracciones históricas (ver split_interval).
+# Cada ventana cuesta al menos una petición aunque esté vacía: por defecto una sola
+HISTORY_WINDOWS = int(os.getenv('HISTORY_WINDOWS', '1'))
+MIN_WINDOW_MS = 24 * 60 * 60 * 1000
+
+# Usar StartSyncExecution (solo state machines Express): devuelve la salida sin polling
+SFN_SYNC_EXECUTION = os.getenv('SFN_SYNC_EXECUTION', '0').lower() in ('1', 'true')
+
+# Con BULK_FILLS activo, a partir de cuántos símbolos /extract/fills pagina todo el historial
+# global de fills en vez de pedir una página por símbolo (cambia el alcance del resultado)
+BULK_FILLS = os.getenv('BULK_FILLS', '0').lower() in ('1', 'true')
+BULK_FILLS_MIN_SYMBOLS = 5
+
+# Rango por defecto de las extracciones en Step Functions
+SECONDS_PER_30D = 30 * 86400
+
+# Tiempo máximo de espera (segundos) para una ejecución de Step Functions
+SFN_WAIT_TIMEOUT = float(os.getenv('SFN_WAIT_TIMEOUT', '900'))
+
+@functools.lru_cache(maxsize=2)
+def _aws_client(service: str):
+    """boto3 client for `service` pointing to LocalStack (one per service, thread-safe)"""
+    return boto3.client(
+        service,
+        region_name=AWS_REGION,
+        aws_access_key_id='test',
+        aws_secret_access_key='test',
+        endpoint_url='http://localhost:4566',
+        config=_BOTO_CONFIG
+    )
+
+@functools.lru_cache(maxsize=None)
+def _ensure_bucket(bucket_name: str) -> None:
+    """Create the bucket if it doesn't exist (checked once per process)"""
+    s3_client = _aws_client('s3')
+    try:
+        s3_client.head_bucket(Bucket=bucket_name)
+        print(f"Bucket '{bucket_name}' already exists.")
+    except ClientError:
+        print(f"Creating bucket '{bucket_name}'...")
+        s3_client.create_bucket(Bucket=bucket_name)
+
+# Sesión HTTP compartida: reutiliza conexiones TCP/TLS con api.bitget.com entre peticiones e hilos
+SESSION = build_session()
+
+@functools.lru_cache(maxsize=1)
+def _bitget_client() -> BitgetClient:
+    """Bitget client shared by all handlers (uses the pooled SESSION)"""
+    return BitgetClient(
+        BITGET_API_KEY,
+        BITGET_SECRET_KEY,
+        BITGET_PASSPHRASE,
+        session=SESSION
+    )
+
+def cached_futures_symbols(client: BitgetClient) -> List[str]:
+    """Futures symbol list, cached for SYMBOLS_CACHE_TTL seconds"""
+    with _symbols_lock:
+        if 'syms' in _symbols_cache:
+            return _symbols_cache['syms']
+        syms = client.get_futures_symbols()
+        # Una lista vacía es un error de la API: no se cachea
+        if syms:
+            _symbols_cache['syms'] = syms
+        return syms
 
 class ExtractRequest(BaseModel):
     symbols: List[str]
 
+    @field_validator('symbols')
+    @classmethod
+    def _dedup_symbols(cls, v):
+        # Quitar símbolos repetidos conservando el orden para no duplicar llamadas a Bitget
+        return list(dict.fromkeys(v))
+
 class ExtractResponse(BaseModel):
     success: bool
     data: List[Dict]
@@ -31,6 +201,41 @@ class ExtractFuturesRequest(BaseModel):
     start_time: Optional[int] = None  # ms since epoch (opcional)
     end_time: Optional[int] = None    # ms since epoch (opcional)
 
+    @field_validator('symbols')
+    @classmethod
+    def _dedup_symbols(cls, v):
+        return list(dict.fromkeys(v)) if v else v
+
+def split_interval(start_time: Optional[int], end_time: Optional[int],
+                   n: int) -> List[Tuple[Optional[int], Optional[int]]]:
+    """Split [start_time, end_time] into up to n disjoint windows of at least one day"""
+    if start_time is None or end_time is None or n <= 1:
+        return [(start_time, end_time)]
+    
+    span = end_time - start_time
+    n = max(1, min(n, span // MIN_WINDOW_MS))
+    step = span // n
+    windows = []
+    for i in range(n):
+        w0 = start_time + i * step
+        w1 = end_time if i == n - 1 else w0 + step - 1
+        windows.append((w0, w1))
+    return windows
+
+def _post_process(batches: List[Tuple[str, List[Dict]]]) -> List[Dict]:
+    """Tag, deduplicate by (symbol, orderId) and sort (symbol, orders) batches newest first"""
+    # El símbolo se materializa aquí, en la misma pasada del dedup (conserva el orden de primera aparición)
+    unique: Dict[tuple, Dict] = {}
+    for symbol, batch in batches:
+        for o in batch:
+            o.setdefault('symbol', symbol)
+            unique[(symbol, o.get('orderId'))] = o
+    deduped_orders = list(unique.values())
+    
+    # Sort chronologically (by creation time) - más reciente primero
+    deduped_orders.sort(key=lambda x: int(x.get('ctime') or x.get('cTime') or 0), reverse=True)
+    return deduped_orders
+
 def extract_futures_orders_local(symbols: Optional[List[str]] = None, 
                                 start_time: Optional[int] = None, 
                                 end_time: Optional[int] = None,
@@ -39,18 +244,14 @@ def extract_futures_orders_local(symbols: Optional[List[str]] = None,
     start_time_exec = time.time()
     
     print("Initializing Bitget client...")
-    client = BitgetClient(
-        os.getenv('BITGET_API_KEY'),
-        os.getenv('BITGET_SECRET_KEY'),
-        os.getenv('BITGET_PASSPHRASE')
-    )
+    client = _bitget_client()
     
-    print(f"API credentials loaded: KEY={os.getenv('BITGET_API_KEY')[:10]}...")
+    print(f"API credentials loaded: KEY={BITGET_API_KEY[:10]}...")
     
     # Si no se proporcionan símbolos, obtener todos los símbolos de futuros
     if not symbols:
         print("Fetching all futures symbols...")
-        symbols = client.get_futures_symbols()
+        symbols = cached_futures_symbols(client)
         if not symbols:
             return {
                 'success': False,
@@ -63,26 +264,32 @@ def extract_futures_orders_local(symbols: Optional[List[str]] = None,
     else:
         print(f"Using provided symbols: {symbols}")
     
-    all_orders = []
+    per_symbol_orders = []
     
-    def fetch_symbol_futures_orders(symbol: str):
+    def fetch_symbol_futures_orders(symbol: str, window_start: Optional[int], window_end: Optional[int]):
+        cache_key = (symbol, window_start, window_end)
+        with _orders_cache_lock:
+            cached = _orders_cache.get(cache_key)
+        if cached is not None:
+            logger.info("Using cached orders for %s", symbol)
+            return cached
         try:
-            print(f"Fetching futures orders for {symbol}...")
+            logger.info("Fetching futures orders for %s...", symbol)
+            # raise_on_error: una paginación cortada por un error no debe quedar en el cache
             orders = BitgetClient.fetch_all_futures_history_for_symbol(
                 client=client,
                 symbol=symbol,
-                start_time=start_time,
-                end_time=end_time,
+                start_time=window_start,
+                end_time=window_end,
                 per_page=100,
-                sleep_between=0.12
+                raise_on_error=True
             )
-            # Asegurar que cada orden tenga el símbolo
-            for order in orders:
-                order['symbol'] = symbol
-            print(f"Fetched {len(orders)} orders for {symbol}")
+            logger.info("Fetched %s orders for %s", len(orders), symbol)
+            with _orders_cache_lock:
+                _orders_cache[cache_key] = orders
             return orders
         except Exception as e:
-            print(f"Error fetching {symbol}: {e}")
+            logger.warning("Error fetching %s: %s", symbol, e)
             return []
     
     # Selección de símbolos según modo de prueba
@@ -93,42 +300,28 @@ def extract_futures_orders_local(symbols: Optional[List[str]] = None,
         selected_symbols = symbols
         print(f"Production mode. Using all {len(selected_symbols)} symbols")
 
-    # Paralelismo según modo
-    if test_mode:
-        max_workers = min(len(selected_symbols), 3)
-    else:
-        max_workers = min(len(selected_symbols), 10)
-    print(f"Starting parallel extraction with {max_workers} workers...")
-    
-    with ThreadPoolExecutor(max_workers=max_workers) as executor:
-        future_to_symbol = {executor.submit(fetch_symbol_futures_orders, symbol): symbol 
-                           for symbol in selected_symbols}
-        
-        for future in as_completed(future_to_symbol):
-            symbol = future_to_symbol[future]
-            try:
-                orders = future.result()
-                if orders:
-                    all_orders.extend(orders)
-                    print(f"Added {len(orders)} orders from {symbol}. Total so far: {len(all_orders)}")
-                else:
-                    print(f"No orders found for {symbol}")
-            except Exception as exc:
-                print(f"Symbol {symbol} generated an exception: {exc}")
-    
-    # Deduplicar por orderId y ordenar cronológicamente
-    seen = set()
-    deduped_orders = []
-    for order in all_orders:
-        order_id = order.get('orderId')
-        symbol = order.get('symbol')
-        key = (symbol, order_id)
-        if key not in seen:
-            seen.add(key)
-            deduped_orders.append(order)
+    # Paralelismo según modo: límite por petición sobre el pool compartido
+    max_workers = min(len(selected_symbols), 3 if test_mode else 10)
     
-    # Sort chronologically (by creation time) - más reciente primero
-    deduped_orders.sort(key=lambda x: int(x.get('ctime') or x.get('cTime') or 0), reverse=True)
+    # Cada símbolo se descarga en ventanas de tiempo disjuntas que corren en paralelo
+    windows = split_interval(start_time, end_time, HISTORY_WINDOWS)
+    print(f"Starting parallel extraction with {max_workers} workers "
+          f"({len(windows)} time windows per symbol)...")
+    
+    tasks = [(symbol, w0, w1) for symbol in selected_symbols for w0, w1 in windows]
+    
+    # Resultados en orden, con como mucho max_workers tareas de esta petición en el pool;
+    # fetch_symbol_futures_orders ya captura sus propios errores
+    results = _bounded_map(lambda task: fetch_symbol_futures_orders(*task), tasks, max_workers)
+    for (symbol, _, _), orders in zip(tasks, results):
+        if orders:
+            per_symbol_orders.append((symbol, orders))
+            logger.info("Added %s orders from %s", len(orders), symbol)
+        else:
+            logger.info("No orders found for %s", symbol)
+    
+    # El símbolo se etiqueta de forma diferida dentro del dedup
+    deduped_orders = _post_process(per_symbol_orders)
     
     duration = time.time() - start_time_exec
     
@@ -137,7 +330,7 @@ def extract_futures_orders_local(symbols: Optional[List[str]] = None,
     # Guardar si tenemos órdenes (también en modo prueba)
     saved_file = None
     if deduped_orders:
-        saved_file = save_orders_to_json(deduped_orders, duration, len(selected_symbols))
+        saved_file = save_orders(deduped_orders, duration, len(selected_symbols))
     else:
         print("No orders found to save")
     
@@ -166,8 +359,8 @@ def save_orders_to_json(orders: List[Dict], duration: float, symbol_count: int):
             "data": orders
         }
         
-        with open(filename, 'w', encoding='utf-8') as f:
-            json.dump(result, f, indent=2, ensure_ascii=False)
+        with open(filename, 'wb') as f:
+            f.write(orjson.dumps(result, option=orjson.OPT_INDENT_2))
         
         print(f"Orders saved to: {os.path.abspath(filename)}")
         return filename
@@ -176,19 +369,105 @@ def save_orders_to_json(orders: List[Dict], duration: float, symbol_count: int):
         print(f"Error saving orders to JSON: {e}")
         return None
 
-def extract_orders_aws(symbols: List[str]) -> Dict:
+def wait_for_execution(sf_client, execution_arn: str,
+                       timeout: float = SFN_WAIT_TIMEOUT) -> Dict:
+    """Wait for a Step Functions execution using exponential backoff (0.1s -> 1s)"""
+    start_wait = time.time()
+    deadline = start_wait + timeout
+    last_status = None
+    delay = 0.1
+    
+    while time.time() < deadline:
+        exec_response = sf_client.describe_execution(executionArn=execution_arn)
+        status = exec_response['status']
+        
+        if status != last_status:
+            elapsed = time.time() - start_wait
+            print(f"Step Function status: {status} (elapsed: {elapsed:.1f}s)")
+            last_status = status
+
+        if status == 'SUCCEEDED':
+            return exec_response
+        elif status == 'FAILED':
+            error_details = exec_response.get('error', 'Unknown error')
+            cause = exec_response.get('cause', '')
+            raise Exception(f"Step Function failed: {error_details}. Cause: {cause}")
+        elif status in ['TIMED_OUT', 'ABORTED']:
+            raise Exception(f"Step Function {status.lower()}")
+        
+        time.sleep(delay)
+        delay = min(delay * 1.5, 1.0)
+    
+    raise Exception(f"Step Function did not finish within {timeout:.0f}s")
+
+def save_orders_to_ndjson(orders: List[Dict], duration: float, symbol_count: int):
+    """Stream orders to a local NDJSON file: one metadata line, then one order per line"""
+    try:
+        timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
+        # Save in project root
+        filename = f"bitget_futures_orders_{timestamp}.ndjson"
+        
+        meta = {
+            "success": True,
+            "extraction_timestamp": timestamp,
+            "duration_seconds": round(duration, 2),
+            "total_orders": len(orders),
+            "processed_symbols": symbol_count
+        }
+        
+        with open(filename, 'wb') as f:
+            f.write(orjson.dumps({"meta": meta}))
+            f.write(b"\n")
+            for order in orders:
+                f.write(orjson.dumps(order))
+                f.write(b"\n")
+        
+        print(f"Orders saved to: {os.path.abspath(filename)}")
+        return filename
+        
+    except Exception as e:
+        print(f"Error saving orders to NDJSON: {e}")
+        return None
+
+def save_orders(orders: List[Dict], duration: float, symbol_count: int):
+    """Save orders locally as JSON, or as NDJSON when NDJSON_OUTPUT is enabled"""
+    if NDJSON_OUTPUT:
+        return save_orders_to_ndjson(orders, duration, symbol_count)
+    return save_orders_to_json(orders, duration, symbol_count)
+
+def _iter_ndjson_chunks(orders: List[Dict]):
+    """Yield one orjson-encoded line per order"""
+    for order in orders:
+        yield orjson.dumps(order)
+        yield b"\n"
+
+def _iter_json_chunks(result: Dict):
+    """Yield a result dict as a single JSON document, encoding one order at a time"""
+    meta = orjson.dumps({k: v for k, v in result.items() if k != 'data'})
+    yield meta[:-1]  # sin la llave de cierre: 'data' va al final
+    yield b',"data":[' if len(meta) > 2 else b'"data":['
+    for i, order in enumerate(result.get('data', [])):
+        if i:
+            yield b","
+        yield orjson.dumps(order)
+    yield b"]}"
+
+def _load_collector_orders(s3_location: str) -> List[Dict]:
+    """Read back the orders the collector saved at s3://bucket/key (gzipped JSON or NDJSON)"""
+    bucket, _, key = s3_location[len('s3://'):].partition('/')
+    obj = _aws_client('s3').get_object(Bucket=bucket, Key=key)
+    with gzip.GzipFile(fileobj=obj['Body']) as body:
+        if key.endswith('.ndjson.gz'):
+            return [orjson.loads(line) for line in body if line.strip()]
+        return orjson.loads(body.read()).get('data', [])
+
+def extract_orders_aws(symbols: List[str], start_time: Optional[int] = None,
+                       end_time: Optional[int] = None) -> Dict:
     """Extract orders using AWS Step Functions with MASSIVE PARALLEL execution"""
     print(f"Executing MASSIVE parallel extraction for {len(symbols)} symbols using Step Functions")
     
     try:
-        # Step Functions client pointing to LocalStack
-        sf_client = boto3.client(
-            'stepfunctions',
-            region_name=os.getenv('AWS_REGION', 'us-east-1'),
-            aws_access_key_id='test',
-            aws_secret_access_key='test',
-            endpoint_url='http://localhost:4566'
-        )
+        sf_client = _aws_client('stepfunctions')
 
         # Split symbols into batches for parallel processing
         BATCH_SIZE = 25  # Each worker processes 25 symbols
@@ -200,90 +479,96 @@ def extract_orders_aws(symbols: List[str]) -> Dict:
         print(f"Created {len(symbol_batches)} batches of ~{BATCH_SIZE} symbols each")
 
         # Create input for Step Functions with parallel workers
+        # Un solo "ahora" para que el rango y el execution_id sean coherentes
+        now_ms = int(time.time() * 1000)
         input_data = {
             'symbol_batches': symbol_batches,
             'use_fills': True,  # Use fills instead of orders (more likely to have data)
-            'start_time': int((time.time() - (30 * 24 * 3600)) * 1000),  # Last 30 days
-            'end_time': int(time.time() * 1000),
+            'start_time': start_time or now_ms - SECONDS_PER_30D * 1000,  # Last 30 days por defecto
+            'end_time': end_time or now_ms,
             'total_symbols': len(symbols),
-            'execution_id': f"extraction_{int(time.time())}"
+            'execution_id': f"extraction_{now_ms // 1000}"
         }
 
         print(f"Step Functions input: {len(symbol_batches)} parallel workers")
 
-        # Start Step Function execution
-        response = sf_client.start_execution(
-            stateMachineArn=os.getenv(
-                'STATE_MACHINE_ARN',
-                'arn:aws:states:us-east-1:000000000000:stateMachine:BitgetMassiveExtractionStateMachine'
-            ),
-            input=json.dumps(input_data)
-        )
+        if SFN_SYNC_EXECUTION:
+            # Express workflow: una sola llamada que devuelve la salida, sin polling
+            exec_response = sf_client.start_sync_execution(
+                stateMachineArn=STATE_MACHINE_ARN,
+                input=orjson.dumps(input_data).decode('utf-8')
+            )
+            if exec_response['status'] != 'SUCCEEDED':
+                error_details = exec_response.get('error', 'Unknown error')
+                cause = exec_response.get('cause', '')
+                raise Exception(f"Step Function {exec_response['status'].lower()}: {error_details}. Cause: {cause}")
+        else:
+            # Start Step Function execution
+            response = sf_client.start_execution(
+                stateMachineArn=STATE_MACHINE_ARN,
+                input=orjson.dumps(input_data).decode('utf-8')
+            )
 
-        execution_arn = response['executionArn']
-        print(f"Started Step Function execution: {execution_arn}")
+            execution_arn = response['executionArn']
+            print(f"Started Step Function execution: {execution_arn}")
 
-        # Wait for execution to complete with progress updates
-        start_wait = time.time()
-        last_status = None
+            # Wait for execution to complete with progress updates
+            exec_response = wait_for_execution(sf_client, execution_arn)
+        result = orjson.loads(exec_response['output'])
+        print(f"Step Function completed successfully!")
         
-        while True:
-            exec_response = sf_client.describe_execution(executionArn=execution_arn)
-            status = exec_response['status']
-            
-            if status != last_status:
-                elapsed = time.time() - start_wait
-                print(f"Step Function status: {status} (elapsed: {elapsed:.1f}s)")
-                last_status = status
-
-            if status == 'SUCCEEDED':
-                result = json.loads(exec_response['output'])
-                print(f"Step Function completed successfully!")
-                break
-            elif status == 'FAILED':
-                error_details = exec_response.get('error', 'Unknown error')
-                cause = exec_response.get('cause', '')
-                raise Exception(f"Step Function failed: {error_details}. Cause: {cause}")
-            elif status in ['TIMED_OUT', 'ABORTED']:
-                raise Exception(f"Step Function {status.lower()}")
-            
-            time.sleep(2)  # Check every 2 seconds
+        # El collector solo devuelve la ubicación: las órdenes se leen de su archivo en S3
+        if result.get('s3_location'):
+            result['data'] = _load_collector_orders(result['s3_location'])
 
         # Save result to S3
-        s3_client = boto3.client(
-            's3',
-            region_name=os.getenv('AWS_REGION', 'us-east-1'),
-            aws_access_key_id='test',
-            aws_secret_access_key='test',
-            endpoint_url='http://localhost:4566'
-        )
+        s3_client = _aws_client('s3')
 
         bucket_name = 'bitget-massive-results'
         
-        # Create bucket if it doesn't exist
-        try:
-            s3_client.head_bucket(Bucket=bucket_name)
-            print(f"Bucket '{bucket_name}' already exists.")
-        except:
-            print(f"Creating bucket '{bucket_name}'...")
-            s3_client.create_bucket(Bucket=bucket_name)
+        _ensure_bucket(bucket_name)
 
-        # Save massive result JSON
+        # Save massive result (JSON, o NDJSON + metadata si NDJSON_OUTPUT está activo)
         timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
-        filename = f"bitget_massive_extraction_{timestamp}.json"
+        if NDJSON_OUTPUT:
+            filename = f"bitget_massive_extraction_{timestamp}.ndjson.zst"
+            content_type = 'application/x-ndjson'
+            
+            metadata = {k: v for k, v in result.items() if k != 'data'}
+            s3_client.put_object(
+                Bucket=bucket_name,
+                Key=f"bitget_massive_extraction_{timestamp}_meta.json",
+                Body=orjson.dumps(metadata),
+                ContentType='application/json'
+            )
+            
+            chunks = _iter_ndjson_chunks(result.get('data', []))
+        else:
+            filename = f"bitget_massive_extraction_{timestamp}.json.zst"
+            content_type = 'application/json'
+            chunks = _iter_json_chunks(result)
         
-        json_bytes = json.dumps(result, indent=2, ensure_ascii=False).encode('utf-8')
+        # Comprimir por trozos a un archivo temporal (en disco si crece mucho),
+        # sin tener nunca todo el JSON sin comprimir en memoria
+        body = tempfile.SpooledTemporaryFile(max_size=SPOOL_MAX_SIZE)
+        with _zstd_lock, _ZSTD.stream_writer(body, closefd=False) as writer:
+            for chunk in chunks:
+                writer.write(chunk)
+        body.seek(0)
         
-        s3_client.put_object(
-            Bucket=bucket_name,
-            Key=filename,
-            Body=json_bytes,
-            ContentType='application/json'
-        )
+        with body:
+            s3_client.upload_fileobj(
+                body,
+                bucket_name,
+                filename,
+                ExtraArgs={'ContentType': content_type, 'ContentEncoding': 'zstd'},
+                Config=_TRANSFER_CONFIG
+            )
 
-        # Verify save
-        objects = s3_client.list_objects_v2(Bucket=bucket_name)
-        print(f"Files in bucket '{bucket_name}': {[obj['Key'] for obj in objects.get('Contents', [])]}")
+        # Listar el bucket es otra llamada a S3 por extracción: solo para depurar
+        if DEBUG_S3:
+            objects = s3_client.list_objects_v2(Bucket=bucket_name)
+            print(f"Files in bucket '{bucket_name}': {[obj['Key'] for obj in objects.get('Contents', [])]}")
         print(f"Massive result saved to LocalStack S3: s3://{bucket_name}/{filename}")
 
         # Add S3 location to result
@@ -295,9 +580,28 @@ def extract_orders_aws(symbols: List[str]) -> Dict:
     except Exception as e:
         print(f"AWS extraction failed, falling back to local: {e}")
         # Fallback to local extraction
-        return extract_futures_orders_local(symbols=symbols, test_mode=True)
+        return extract_futures_orders_local(symbols=symbols, start_time=start_time,
+                                            end_time=end_time, test_mode=True)
+
+def extraction_response(result: Dict) -> ORJSONResponse:
+    """Serialize an extraction result directly, keeping only the ExtractResponse fields"""
+    # Sin response_model: evita que FastAPI vuelva a validar y recorrer toda la lista de órdenes
+    return ORJSONResponse(content={field: result.get(field) for field in ExtractResponse.model_fields})
+
+async def run_coalesced(key: tuple, func, *args, **kwargs) -> Dict:
+    """Run a blocking extraction in a thread, sharing it with identical in-flight calls"""
+    task = _inflight.get(key)
+    if task is None:
+        task = asyncio.create_task(asyncio.to_thread(func, *args, **kwargs))
+        _inflight[key] = task
+        task.add_done_callback(lambda _: _inflight.pop(key, None))
+    else:
+        print(f"Joining in-flight extraction for {len(key[1])} symbols")
+    # shield: si un cliente se desconecta no se cancela la tarea de los demás
+    return await asyncio.shield(task)
 
-@app.post("/extract/massive", response_model=ExtractResponse)
+@app.post("/extract/massive", response_model=None,
+          responses={200: {"model": ExtractResponse}})
 async def extract_massive_futures_orders(request: ExtractFuturesRequest):
     """
     MASSIVE parallel extraction of ALL futures orders using Step Functions
@@ -308,16 +612,12 @@ async def extract_massive_futures_orders(request: ExtractFuturesRequest):
     start_time_total = time.time()
     
     # Initialize client to get all symbols if none provided
-    client = BitgetClient(
-        os.getenv('BITGET_API_KEY'),
-        os.getenv('BITGET_SECRET_KEY'),
-        os.getenv('BITGET_PASSPHRASE')
-    )
+    client = _bitget_client()
     
     # Get all futures symbols if none provided
     if not request.symbols:
         print("Fetching ALL futures symbols for massive extraction...")
-        symbols = client.get_futures_symbols()
+        symbols = await asyncio.to_thread(cached_futures_symbols, client)
         if not symbols:
             raise HTTPException(status_code=500, detail="Could not fetch futures symbols")
         print(f"Found {len(symbols)} futures symbols for massive extraction")
@@ -333,23 +633,27 @@ async def extract_massive_futures_orders(request: ExtractFuturesRequest):
     estimated_time = estimated_batches * 2  # ~2 minutes per batch in parallel
     print(f"Estimated processing: {estimated_batches} parallel workers, ~{estimated_time} minutes")
     
-    result = extract_orders_aws(symbols)
+    result = await run_coalesced(('aws', frozenset(symbols), request.start_time, request.end_time),
+                                 extract_orders_aws, symbols, request.start_time, request.end_time)
     
     total_duration = time.time() - start_time_total
     print(f"=== MASSIVE EXTRACTION COMPLETED in {total_duration:.1f}s ===")
     print(f"Total orders extracted: {result.get('total_orders', 0)}")
     
-    return ExtractResponse(**result)
+    return extraction_response(result)
 
-@app.post("/extract/futures", response_model=ExtractResponse)
+@app.post("/extract/futures", response_model=None,
+          responses={200: {"model": ExtractResponse}})
 async def extract_futures_orders(request: ExtractFuturesRequest):
     """Extract futures orders from Bitget for given symbols (or all symbols if none provided)"""
     
     print(f"Received request: symbols={request.symbols}, start_time={request.start_time}, end_time={request.end_time}")
     
     # Check if running in debug/local mode
-    if os.getenv('DEBUG', 'true').lower() == 'true':
-        result = extract_futures_orders_local(
+    if FUTURES_LOCAL_MODE:
+        result = await run_coalesced(
+            ('local', frozenset(request.symbols or ()), request.start_time, request.end_time),
+            extract_futures_orders_local,
             symbols=request.symbols,
             start_time=request.start_time,
             end_time=request.end_time
@@ -358,18 +662,16 @@ async def extract_futures_orders(request: ExtractFuturesRequest):
         # Para AWS, necesitamos símbolos específicos
         if not request.symbols:
             # Obtener símbolos primero
-            client = BitgetClient(
-                os.getenv('BITGET_API_KEY'),
-                os.getenv('BITGET_SECRET_KEY'),
-                os.getenv('BITGET_PASSPHRASE')
-            )
-            request.symbols = client.get_futures_symbols()
+            client = _bitget_client()
+            request.symbols = await asyncio.to_thread(cached_futures_symbols, client)
         
-        result = extract_orders_aws(request.symbols)
+        result = await run_coalesced(('aws', frozenset(request.symbols), request.start_time, request.end_time),
+                                     extract_orders_aws, request.symbols, request.start_time, request.end_time)
     
-    return ExtractResponse(**result)
+    return extraction_response(result)
 
-@app.post("/extract", response_model=ExtractResponse)
+@app.post("/extract", response_model=None,
+          responses={200: {"model": ExtractResponse}})
 async def extract_orders(request: ExtractRequest):
     """Legacy endpoint - Extract orders from Bitget for given symbols"""
     
@@ -377,22 +679,20 @@ async def extract_orders(request: ExtractRequest):
         raise HTTPException(status_code=400, detail="Symbols list cannot be empty")
     
     # Check if running in debug/local mode
-    if os.getenv('DEBUG', 'false').lower() == 'true':
-        result = extract_futures_orders_local(symbols=request.symbols)
+    if DEBUG_MODE:
+        result = await run_coalesced(('local', frozenset(request.symbols), None, None),
+                                     extract_futures_orders_local, symbols=request.symbols)
     else:
-        result = extract_orders_aws(request.symbols)
+        result = await run_coalesced(('aws', frozenset(request.symbols), None, None),
+                                     extract_orders_aws, request.symbols)
     
-    return ExtractResponse(**result)
+    return extraction_response(result)
 
 @app.get("/test/auth")
-async def test_auth():
+def test_auth():
     """Test Bitget API authentication and basic connectivity"""
     try:
-        client = BitgetClient(
-            os.getenv('BITGET_API_KEY'),
-            os.getenv('BITGET_SECRET_KEY'),
-            os.getenv('BITGET_PASSPHRASE')
-        )
+        client = _bitget_client()
         
         print("Testing basic API connectivity...")
         
@@ -401,23 +701,23 @@ async def test_auth():
         headers = {'Content-Type': 'application/json'}
         url = f"https://api.bitget.com{path}"
         
-        response = requests.get(url, headers=headers, timeout=30)
+        response = SESSION.get(url, headers=headers, timeout=30)
         server_time_data = response.json()
         
         print(f"Server time response: {server_time_data}")
         
         # Test 2: Get futures symbols (no auth required)
-        symbols = client.get_futures_symbols()
+        symbols = cached_futures_symbols(client)
         
         # Test 3: Try to get account info (requires auth)
         path = "/api/v2/mix/account/accounts"
         params = {"productType": "usdt-futures"}
-        query_string = "&".join([f"{k}={v}" for k, v in params.items()])
+        query_string = urlencode(params)
         full_path = f"{path}?{query_string}"
         headers = client._get_headers('GET', full_path)
         url = f"https://api.bitget.com{full_path}"
         
-        auth_response = requests.get(url, headers=headers, timeout=30)
+        auth_response = SESSION.get(url, headers=headers, timeout=30)
         auth_data = auth_response.json()
         
         print(f"Auth test response: {auth_data}")
@@ -442,14 +742,10 @@ async def test_auth():
         }
 
 @app.get("/test/orders/{symbol}")
-async def test_orders_for_symbol(symbol: str):
+def test_orders_for_symbol(symbol: str):
     """Test fetching orders for a specific symbol with detailed logging"""
     try:
-        client = BitgetClient(
-            os.getenv('BITGET_API_KEY'),
-            os.getenv('BITGET_SECRET_KEY'),
-            os.getenv('BITGET_PASSPHRASE')
-        )
+        client = _bitget_client()
         
         print(f"Testing orders for symbol: {symbol}")
         
@@ -462,12 +758,12 @@ async def test_orders_for_symbol(symbol: str):
             "symbol": symbol,
             "productType": "usdt-futures"
         }
-        query_string = "&".join([f"{k}={v}" for k, v in params.items()])
+        query_string = urlencode(params)
         full_path = f"{path}?{query_string}"
         headers = client._get_headers('GET', full_path)
         url = f"https://api.bitget.com{full_path}"
         
-        current_response = requests.get(url, headers=headers, timeout=30)
+        current_response = SESSION.get(url, headers=headers, timeout=30)
         current_data = current_response.json()
         
         # Test fills/trades
@@ -476,12 +772,12 @@ async def test_orders_for_symbol(symbol: str):
             "symbol": symbol,
             "productType": "usdt-futures"
         }
-        query_string = "&".join([f"{k}={v}" for k, v in params.items()])
+        query_string = urlencode(params)
         full_path = f"{path}?{query_string}"
         headers = client._get_headers('GET', full_path)
         url = f"https://api.bitget.com{full_path}"
         
-        fills_response = requests.get(url, headers=headers, timeout=30)
+        fills_response = SESSION.get(url, headers=headers, timeout=30)
         fills_data = fills_response.json()
         
         return {
@@ -514,22 +810,17 @@ async def test_orders_for_symbol(symbol: str):
             "error": str(e)
         }
 
-@app.post("/extract/fills")
-async def extract_futures_fills(request: ExtractFuturesRequest):
-    """Extract futures fills/trades instead of orders - these are actual executed trades"""
+def extract_futures_fills_local(symbols: Optional[List[str]] = None,
+                                start_time: Optional[int] = None,
+                                end_time: Optional[int] = None) -> Dict:
+    """Extract futures fills locally using ThreadPool"""
     start_time_exec = time.time()
     
-    client = BitgetClient(
-        os.getenv('BITGET_API_KEY'),
-        os.getenv('BITGET_SECRET_KEY'),
-        os.getenv('BITGET_PASSPHRASE')
-    )
+    client = _bitget_client()
     
     # Si no se proporcionan símbolos, obtener algunos símbolos principales
-    if not request.symbols:
+    if not symbols:
         symbols = ["BTCUSDT", "ETHUSDT", "XRPUSDT", "BCHUSDT", "LTCUSDT"]
-    else:
-        symbols = request.symbols
     
     print(f"Extracting fills for symbols: {symbols}")
     
@@ -537,55 +828,45 @@ async def extract_futures_fills(request: ExtractFuturesRequest):
     
     def fetch_symbol_fills(symbol: str):
         try:
-            path = "/api/v2/mix/order/fills"
-            params = {
-                "symbol": symbol,
-                "productType": "usdt-futures",
-                "limit": 100
-            }
-            
-            if request.start_time:
-                params["startTime"] = request.start_time
-            if request.end_time:
-                params["endTime"] = request.end_time
-            
-            query_string = "&".join([f"{k}={v}" for k, v in params.items()])
-            full_path = f"{path}?{query_string}"
-            headers = client._get_headers('GET', full_path)
-            url = f"https://api.bitget.com{full_path}"
-            
-            print(f"Fetching fills for {symbol}...")
-            response = requests.get(url, headers=headers, timeout=30)
-            data = response.json()
+            logger.info("Fetching fills for %s...", symbol)
+            # Pasa por el cliente: comparte el token bucket de FILLS_PATH con el resto de peticiones
+            data = client.get_futures_fills(symbol, start_time=start_time or None,
+                                            end_time=end_time or None, limit=100)
             
             if data.get('code') == '00000':
                 fills = data.get('data', {}).get('fillList', [])
-                for fill in fills:
-                    fill['symbol'] = symbol
-                print(f"Found {len(fills)} fills for {symbol}")
+                if fills and 'symbol' not in fills[0]:
+                    for fill in fills:
+                        fill['symbol'] = symbol
+                logger.info("Found %s fills for %s", len(fills), symbol)
                 return fills
             else:
-                print(f"Error for {symbol}: {data.get('msg')}")
+                logger.warning("Error for %s: %s", symbol, data.get('msg'))
                 return []
                 
         except Exception as e:
-            print(f"Error fetching fills for {symbol}: {e}")
+            logger.warning("Error fetching fills for %s: %s", symbol, e)
             return []
     
-    # Ejecutar en paralelo
-    with ThreadPoolExecutor(max_workers=3) as executor:
-        future_to_symbol = {executor.submit(fetch_symbol_fills, symbol): symbol 
-                           for symbol in symbols}
-        
-        for future in as_completed(future_to_symbol):
-            symbol = future_to_symbol[future]
-            try:
-                fills = future.result()
-                if fills:
-                    all_fills.extend(fills)
-                    print(f"Added {len(fills)} fills from {symbol}")
-            except Exception as exc:
-                print(f"Symbol {symbol} generated an exception: {exc}")
+    if BULK_FILLS and len(symbols) >= BULK_FILLS_MIN_SYMBOLS:
+        # Una sola paginación global de fills en lugar de una petición por símbolo
+        wanted = {symbol.upper() for symbol in symbols}
+        fills_by_symbol = defaultdict(list)
+        for fill in BitgetClient.fetch_all_futures_fills_bulk(
+            client, start_time=start_time, end_time=end_time
+        ):
+            fill_symbol = (fill.get('symbol') or '').upper()
+            if fill_symbol in wanted:
+                fills_by_symbol[fill_symbol].append(fill)
+        for symbol, fills in fills_by_symbol.items():
+            all_fills.extend(fills)
+            logger.info("Added %s fills from %s", len(fills), symbol)
+    else:
+        # Ejecutar en paralelo (máximo 3 peticiones simultáneas por llamada)
+        for symbol, fills in zip(symbols, _bounded_map(fetch_symbol_fills, symbols, 3)):
+            if fills:
+                all_fills.extend(fills)
+                logger.info("Added %s fills from %s", len(fills), symbol)
     
     # Ordenar por timestamp
     all_fills.sort(key=lambda x: int(x.get('cTime', 0)), reverse=True)
@@ -593,7 +874,7 @@ async def extract_futures_fills(request: ExtractFuturesRequest):
     duration = time.time() - start_time_exec
     
     if all_fills:
-        save_orders_to_json(all_fills, duration, len(symbols))
+        save_orders(all_fills, duration, len(symbols))
     
     return {
         "success": True,
@@ -603,16 +884,23 @@ async def extract_futures_fills(request: ExtractFuturesRequest):
         "processed_symbols": len(symbols)
     }
 
+@app.post("/extract/fills")
+async def extract_futures_fills(request: ExtractFuturesRequest):
+    """Extract futures fills/trades instead of orders - these are actual executed trades"""
+    result = await asyncio.to_thread(
+        extract_futures_fills_local,
+        symbols=request.symbols,
+        start_time=request.start_time,
+        end_time=request.end_time
+    )
+    return ORJSONResponse(content=result)
+
 @app.get("/symbols/futures")
-async def get_futures_symbols():
+def get_futures_symbols():
     """Get all available futures symbols"""
     try:
-        client = BitgetClient(
-            os.getenv('BITGET_API_KEY'),
-            os.getenv('BITGET_SECRET_KEY'),
-            os.getenv('BITGET_PASSPHRASE')
-        )
-        symbols = client.get_futures_symbols()
+        client = _bitget_client()
+        symbols = cached_futures_symbols(client)
         return {
             "success": True,
             "symbols": symbols,
@@ -627,4 +915,17 @@ async def health_check():
 
 if __name__ == "__main__":
     import uvicorn
-    uvicorn.run(app, host="127.0.0.1", port=8000)
\ No newline at end of file
+    # uvloop (cuando está instalado) + httptools, sin access log. Un solo proceso por defecto:
+    # el rate limiter, las caches y las extracciones compartidas viven en memoria del proceso
+    web_workers = int(os.getenv('WEB_WORKERS', '1'))
+    uvicorn.run(
+        # Con un proceso se pasa la app ya importada; el import string (necesario para varios
+        # workers) haría que uvicorn volviera a importar el módulo con otro pool, sesión y listener
+        "fastapi_app.main:app" if web_workers > 1 else app,
+        host="127.0.0.1",
+        port=8000,
+        loop="auto",
+        http="httptools",
+        access_log=False,
+        workers=web_workers
+    )
\ No newline at end of file
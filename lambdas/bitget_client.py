@@ -1,39 +1,110 @@
 # Cliente pequeño para Bitget (firma + helpers) - FIXED FOR FUTURES
 
-import hashlib
 import hmac
+import socket
 import base64
+import threading
 import time
-import json
+import orjson
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.connection import HTTPConnection
+from urllib3.util.retry import Retry
 from typing import List, Dict, Optional
+from urllib.parse import urlencode
 import logging
 
 logger = logging.getLogger("bitget_pagination")
 logger.setLevel(logging.INFO)
 
+# Endpoints de futuros USDT usados por el cliente
+CONTRACTS_PATH = "/api/v2/mix/market/contracts"
+HISTORY_ORDERS_PATH = "/api/v2/mix/order/history-orders"
+FILLS_PATH = "/api/v2/mix/order/fills"
+
+class TokenBucket:
+    """Thread-safe token bucket: acquire() only sleeps when the request budget is spent"""
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.ts = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self) -> None:
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.ts) * self.rate)
+            self.ts = now
+            wait = (1 - self.tokens) / self.rate if self.tokens < 1 else 0.0
+            # El token se descuenta ya: quien espera tiene reservado su turno
+            self.tokens -= 1
+        if wait:
+            time.sleep(wait)
+
+# Límite documentado de Bitget: 10 peticiones/s por endpoint (compartido por todos los hilos)
+_BUCKETS = {
+    HISTORY_ORDERS_PATH: TokenBucket(10, 10),
+    FILLS_PATH: TokenBucket(10, 10),
+}
+
+# TCP keep-alive: evita que NATs/balanceadores cierren en silencio conexiones ociosas del pool
+_KEEPALIVE_OPTIONS = [(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)]
+if hasattr(socket, 'TCP_KEEPIDLE'):  # Linux (Lambda); no existe en Windows/macOS
+    _KEEPALIVE_OPTIONS += [
+        (socket.IPPROTO_TCP, socket.TCP_KEEPIDLE, 60),
+        (socket.IPPROTO_TCP, socket.TCP_KEEPINTVL, 15),
+        (socket.IPPROTO_TCP, socket.TCP_KEEPCNT, 4),
+    ]
+
+class KeepAliveAdapter(HTTPAdapter):
+    """HTTPAdapter whose pooled sockets have TCP keep-alive enabled"""
+
+    def init_poolmanager(self, *args, **kwargs):
+        kwargs['socket_options'] = HTTPConnection.default_socket_options + _KEEPALIVE_OPTIONS
+        super().init_poolmanager(*args, **kwargs)
+
+def build_session(pool_connections: int = 32, pool_maxsize: int = 64) -> requests.Session:
+    """Session with keep-alive pooling and retries on 429/5xx for api.bitget.com"""
+    session = requests.Session()
+    session.mount('https://', KeepAliveAdapter(
+        pool_connections=pool_connections,
+        pool_maxsize=pool_maxsize,
+        # Reintentos con backoff exponencial en la capa HTTP; respeta Retry-After en los 429
+        max_retries=Retry(
+            total=5,
+            backoff_factor=0.5,
+            status_forcelist=[429, 500, 502, 503, 504],
+            respect_retry_after_header=True,
+            allowed_methods=frozenset(['GET'])
+        )
+    ))
+    return session
+
 class BitgetClient:
-    def __init__(self, api_key: str, secret_key: str, passphrase: str):
+    def __init__(self, api_key: str, secret_key: str, passphrase: str,
+                 session: Optional[requests.Session] = None):
         self.api_key = api_key
         self.secret_key = secret_key
         self.passphrase = passphrase
+        # La clave HMAC se codifica una sola vez, no en cada firma
+        self._secret_bytes = secret_key.encode('utf-8')
         self.base_url = "https://api.bitget.com"
+        # Sesión reutilizable (keep-alive); se puede compartir entre clientes e hilos
+        self.session = session or build_session()
     
     def _sign(self, timestamp: str, method: str, path: str, body: str = "") -> str:
         """Generate signature for Bitget API"""
         message = timestamp + method + path + body
         signature = base64.b64encode(
-            hmac.new(
-                self.secret_key.encode('utf-8'),
-                message.encode('utf-8'),
-                hashlib.sha256
-            ).digest()
+            hmac.digest(self._secret_bytes, message.encode('utf-8'), 'sha256')
         ).decode('utf-8')
         return signature
     
     def _get_headers(self, method: str, path: str, body: str = "") -> Dict[str, str]:
         """Generate headers for API requests"""
-        timestamp = str(int(time.time() * 1000))
+        timestamp = str(time.time_ns() // 1_000_000)
         signature = self._sign(timestamp, method, path, body)
         
         return {
@@ -47,9 +118,9 @@ class BitgetClient:
     def get_futures_symbols(self) -> List[str]:
         """Get all active futures symbols"""
         try:
-            path = "/api/v2/mix/market/contracts"
+            path = CONTRACTS_PATH
             params = {"productType": "USDT-FUTURES"}  # Corrected case
-            query_string = "&".join([f"{k}={v}" for k, v in params.items()])
+            query_string = urlencode(params)
             full_path = f"{path}?{query_string}"
             
             headers = self._get_headers('GET', full_path)
@@ -57,24 +128,24 @@ class BitgetClient:
             
             print(f"Fetching symbols from: {url}")
             
-            response = requests.get(url, headers=headers, timeout=30)
+            response = self.session.get(url, headers=headers, timeout=30)
             print(f"Response status: {response.status_code}")
             
             response.raise_for_status()
-            data = response.json()
+            data = orjson.loads(response.content)
             
             if data.get('code') != '00000':
-                logger.error(f"API Error getting symbols: {data.get('msg')}")
+                logger.error("API Error getting symbols: %s", data.get('msg'))
                 return []
             
             contracts = data.get('data', [])
             symbols = [contract['symbol'] for contract in contracts if contract.get('symbol')]
             
-            logger.info(f"Found {len(symbols)} futures symbols")
+            logger.info("Found %s futures symbols", len(symbols))
             return symbols
             
         except Exception as e:
-            logger.error(f"Error fetching futures symbols: {str(e)}")
+            logger.error("Error fetching futures symbols: %s", e)
             return []
 
     def get_futures_history_orders(self, symbol: str, start_time: Optional[int] = None, 
@@ -84,7 +155,7 @@ class BitgetClient:
         Get futures historical orders for a specific symbol
         Uses: /api/v2/mix/order/history-orders
         """
-        path = "/api/v2/mix/order/history-orders"
+        path = HISTORY_ORDERS_PATH
         params = {
             "symbol": symbol.strip(),  # Remove any whitespace
             "productType": "USDT-FUTURES",  # Corrected case
@@ -98,21 +169,23 @@ class BitgetClient:
         if end_id:
             params["endId"] = end_id
 
-        query_string = "&".join([f"{k}={v}" for k, v in params.items()])
+        query_string = urlencode(params)
         full_path = f"{path}?{query_string}"
-        headers = self._get_headers('GET', full_path)
         url = f"{self.base_url}{full_path}"
 
         try:
             print(f"Fetching orders for {symbol}: {url}")
-            resp = requests.get(url, headers=headers, timeout=30)
+            # Se firma después de esperar turno: ACCESS-TIMESTAMP no envejece en el rate limiter
+            _BUCKETS[path].acquire()
+            headers = self._get_headers('GET', full_path)
+            resp = self.session.get(url, headers=headers, timeout=30)
             print(f"Response status for {symbol}: {resp.status_code}")
             
             if resp.status_code != 200:
                 print(f"Error response for {symbol}: {resp.text}")
             
             resp.raise_for_status()
-            data = resp.json()
+            data = orjson.loads(resp.content)
             
             print(f"API response code for {symbol}: {data.get('code')}")
             if data.get('code') != '00000':
@@ -123,23 +196,24 @@ class BitgetClient:
             
             return data
         except Exception as e:
-            logger.error(f"futures_history_orders error for {symbol}: {e}")
+            logger.error("futures_history_orders error for %s: %s", symbol, e)
             print(f"Exception for {symbol}: {e}")
             return {"code": "error", "msg": str(e), "data": []}
 
-    def get_futures_fills(self, symbol: str, start_time: Optional[int] = None, 
+    def get_futures_fills(self, symbol: Optional[str], start_time: Optional[int] = None, 
                          end_time: Optional[int] = None, limit: int = 100, 
                          end_id: Optional[str] = None) -> dict:
         """
         Get futures fills/trades (executed orders) - this is more likely to have data
         Uses: /api/v2/mix/order/fills
+        symbol=None returns fills for every USDT-FUTURES contract
         """
-        path = "/api/v2/mix/order/fills"
-        params = {
-            "symbol": symbol.strip(),
-            "productType": "USDT-FUTURES",
-            "limit": min(100, max(1, int(limit)))
-        }
+        path = FILLS_PATH
+        params = {}
+        if symbol:
+            params["symbol"] = symbol.strip()
+        params["productType"] = "USDT-FUTURES"
+        params["limit"] = min(100, max(1, int(limit)))
         
         if start_time is not None:
             params["startTime"] = start_time
@@ -148,17 +222,19 @@ class BitgetClient:
         if end_id:
             params["endId"] = end_id
 
-        query_string = "&".join([f"{k}={v}" for k, v in params.items()])
+        query_string = urlencode(params)
         full_path = f"{path}?{query_string}"
-        headers = self._get_headers('GET', full_path)
         url = f"{self.base_url}{full_path}"
 
         try:
             print(f"Fetching fills for {symbol}: {url}")
-            resp = requests.get(url, headers=headers, timeout=30)
+            # Se firma después de esperar turno: ACCESS-TIMESTAMP no envejece en el rate limiter
+            _BUCKETS[path].acquire()
+            headers = self._get_headers('GET', full_path)
+            resp = self.session.get(url, headers=headers, timeout=30)
             
             resp.raise_for_status()
-            data = resp.json()
+            data = orjson.loads(resp.content)
             
             if data.get('code') != '00000':
                 print(f"API error for {symbol}: {data.get('msg')}")
@@ -169,18 +245,20 @@ class BitgetClient:
             
             return data
         except Exception as e:
-            logger.error(f"futures_fills error for {symbol}: {e}")
+            logger.error("futures_fills error for %s: %s", symbol, e)
             return {"code": "error", "msg": str(e), "data": {"fillList": []}}
 
     @staticmethod
     def fetch_all_futures_history_for_symbol(client, symbol: str, start_time: Optional[int] = None,
                                             end_time: Optional[int] = None, per_page: int = 100,
-                                            max_pages: Optional[int] = None, sleep_between: float = 0.12,
-                                            use_fills: bool = True) -> List[Dict]:
+                                            max_pages: Optional[int] = None, sleep_between: float = 0.0,
+                                            use_fills: bool = True, raise_on_error: bool = False) -> List[Dict]:
         """
         High-level paginator for futures historical data.
         use_fills=True: fetch fills/trades (more likely to have data)
         use_fills=False: fetch orders
+        Pacing comes from the per-endpoint token bucket; sleep_between adds an extra fixed pause.
+        raise_on_error=True raises on an API error instead of returning the pages fetched so far.
         """
         all_items: List[Dict] = []
         end_id: Optional[str] = None
@@ -206,13 +284,17 @@ class BitgetClient:
                         end_id=end_id
                     )
             except Exception as e:
+                # Los errores transitorios ya se reintentaron en la sesión (Retry): no insistir
                 logger.exception("Error calling API: %s", e)
-                time.sleep(1.0)
-                continue
+                if raise_on_error:
+                    raise
+                break
 
             # Check API response
             if resp.get('code') != '00000':
-                logger.error(f"API Error for {symbol}: {resp.get('msg')}")
+                logger.error("API Error for %s: %s", symbol, resp.get('msg'))
+                if raise_on_error:
+                    raise Exception(f"API error for {symbol} on page {page}: {resp.get('msg')}")
                 break
 
             # Get data from response
@@ -223,7 +305,7 @@ class BitgetClient:
                 items = data.get('orderList', []) if isinstance(data, dict) else []
             
             if not items:
-                logger.info(f"No more items for {symbol} on page {page}")
+                logger.info("No more items for %s on page %s", symbol, page)
                 break
 
             all_items.extend(items)
@@ -231,7 +313,7 @@ class BitgetClient:
             # Check if there are more pages
             next_flag = data.get('nextFlag', False) if isinstance(data, dict) else False
             if not next_flag or len(items) < per_page:
-                logger.info(f"No more pages for {symbol} (nextFlag: {next_flag})")
+                logger.info("No more pages for %s (nextFlag: %s)", symbol, next_flag)
                 break
 
             # Use appropriate ID field for pagination
@@ -241,15 +323,36 @@ class BitgetClient:
                 end_id = items[-1].get('orderId')
                 
             if not end_id:
-                logger.warning(f"No ID found in last item for {symbol}")
+                logger.warning("No ID found in last item for %s", symbol)
                 break
 
-            logger.info(f"Fetched page {page} for {symbol}, got {len(items)} items, total so far: {len(all_items)}")
+            logger.info("Fetched page %s for %s, got %s items, total so far: %s", page, symbol, len(items), len(all_items))
 
             if max_pages and page >= max_pages:
                 break
 
-            time.sleep(sleep_between)
+            if sleep_between:
+                time.sleep(sleep_between)
 
-        logger.info(f"Total fetched for {symbol}: {len(all_items)} items")
-        return all_items
\ No newline at end of file
+        logger.info("Total fetched for %s: %s items", symbol, len(all_items))
+        return all_items
+
+    @staticmethod
+    def fetch_all_futures_fills_bulk(client, start_time: Optional[int] = None,
+                                     end_time: Optional[int] = None, per_page: int = 100,
+                                     max_pages: Optional[int] = None,
+                                     sleep_between: float = 0.0) -> List[Dict]:
+        """
+        Paginate fills for ALL USDT futures symbols at once (no symbol filter).
+        Returns the raw fills; callers group them by fill['symbol'].
+        """
+        return BitgetClient.fetch_all_futures_history_for_symbol(
+            client=client,
+            symbol=None,
+            start_time=start_time,
+            end_time=end_time,
+            per_page=per_page,
+            max_pages=max_pages,
+            sleep_between=sleep_between,
+            use_fills=True
+        )
\ No newline at end of file
@@ -1,13 +1,72 @@
-import json
+import gzip
+import io
+import orjson
 import logging
 import os
+import tempfile
 import time
 import boto3
+from boto3.s3.transfer import TransferConfig
 from datetime import datetime
 
+try:
+    import numpy as np
+except ImportError:  # numpy es opcional: sin él se usa list.sort
+    np = None
+
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 
+# NDJSON (una orden por línea) + archivo _meta.json en lugar de un único JSON
+NDJSON_OUTPUT = os.environ.get('NDJSON_OUTPUT', 'false').lower() in ('1', 'true')
+# Subidas grandes en partes de 8 MB; el archivo temporal pasa a disco a partir de 16 MB
+_TRANSFER_CONFIG = TransferConfig(multipart_threshold=8 * 1024 * 1024, use_threads=True)
+SPOOL_MAX_SIZE = 16 * 1024 * 1024
+
+# A partir de este tamaño el orden por fecha se hace con numpy (si está instalado)
+NUMPY_SORT_MIN = 2000
+
+# Cliente S3 creado una sola vez por contenedor (se reutiliza en invocaciones "warm")
+_S3 = None
+
+def _s3():
+    """S3 client for LocalStack, built lazily on first use"""
+    global _S3
+    if _S3 is None:
+        _S3 = boto3.client(
+            's3',
+            region_name=os.environ.get('AWS_REGION', 'us-east-1'),
+            aws_access_key_id=os.environ.get('AWS_ACCESS_KEY_ID', 'test'),
+            aws_secret_access_key=os.environ.get('AWS_SECRET_ACCESS_KEY', 'test'),
+            endpoint_url=os.environ.get('S3_ENDPOINT_URL', 'http://localhost:4566')
+        )
+    return _S3
+
+def _load_offloaded(pointer):
+    """Read back orders a worker offloaded to S3 (gzipped NDJSON, or a gzipped JSON array)"""
+    obj = _s3().get_object(Bucket=pointer['s3_bucket'], Key=pointer['s3_key'])
+    with gzip.GzipFile(fileobj=obj['Body']) as body:
+        if pointer.get('format') == 'ndjson':
+            return [orjson.loads(line) for line in body if line.strip()]
+        return orjson.loads(body.read())
+
+def _oid(order):
+    """Order id regardless of the field name used by the payload"""
+    return order.get('orderId') or order.get('order_id') or order.get('id')
+
+def _get_timestamp(order):
+    """Creation time in ms; cTime first since that is what Bitget v2 returns"""
+    return int(order.get('cTime') or order.get('ctime') or
+               order.get('timestamp') or order.get('createTime') or 0)
+
+def _sort_newest_first(orders):
+    """Sort orders by creation time, newest first (stable for equal timestamps)"""
+    if np is None or len(orders) < NUMPY_SORT_MIN:
+        orders.sort(key=_get_timestamp, reverse=True)
+        return orders
+    ts = np.fromiter((_get_timestamp(o) for o in orders), dtype=np.int64, count=len(orders))
+    return [orders[i] for i in np.argsort(-ts, kind='stable').tolist()]
+
 def lambda_handler(event, context):
     """
     Lambda collector que recibe resultados de todos los workers y genera el archivo JSON final
@@ -24,24 +83,25 @@ def lambda_handler(event, context):
         ...
     ]
     
-    Output:
+    Output (las órdenes unificadas quedan en s3_location, no viajan por Step Functions):
     {
         "success": true,
-        "data": [...],  # Todas las órdenes unificadas
         "duration_seconds": 45.2,
         "total_orders": 17000,
         "processed_symbols": 150,
         "failed_symbols": 2,
-        "s3_location": "s3://bitget-results/futures_orders_20250826_143022.json"
+        "s3_location": "s3://bitget-results/futures_orders_20250826_143022.json.gz"
     }
     """
     
     start_time_collector = time.time()
     
     try:
-        logger.info(f"Collector received {len(event)} worker results")
+        logger.info("Collector received %s worker results", len(event))
         
-        all_orders = []
+        # Órdenes únicas por (symbol, orderId), deduplicadas a medida que llegan
+        unique_orders = {}
+        received_orders = 0
         processed_symbols = 0
         failed_symbols = 0
         processing_stats = []
@@ -56,9 +116,14 @@ def lambda_handler(event, context):
             symbol = result_data.get('symbol', 'unknown')
             success = result_data.get('success', False)
             
-            if success and result_data.get('orders'):
-                orders = result_data['orders']
-                all_orders.extend(orders)
+            if success and (result_data.get('orders') or result_data.get('result_s3')):
+                if result_data.get('result_s3'):
+                    # El worker subió sus órdenes a S3 por superar el límite de respuesta
+                    orders = _load_offloaded(result_data['result_s3'])
+                else:
+                    orders = result_data['orders']
+                unique_orders.update(((o.get('symbol'), _oid(o)), o) for o in orders)
+                received_orders += len(orders)
                 processed_symbols += 1
                 
                 processing_stats.append({
@@ -67,31 +132,17 @@ def lambda_handler(event, context):
                     'processing_time': result_data.get('processingTime', 0)
                 })
                 
-                logger.info(f"Added {len(orders)} orders from {symbol}")
+                logger.info("Added %s orders from %s", len(orders), symbol)
             else:
                 failed_symbols += 1
-                logger.warning(f"Failed to process {symbol}: {result_data.get('error', 'Unknown error')}")
-        
-        # Deduplicar órdenes por orderId y symbol
-        seen = set()
-        deduped_orders = []
-        for order in all_orders:
-            order_id = order.get('orderId') or order.get('order_id') or order.get('id')
-            symbol = order.get('symbol')
-            key = (symbol, order_id)
-            
-            if key not in seen:
-                seen.add(key)
-                deduped_orders.append(order)
+                logger.warning("Failed to process %s: %s", symbol, result_data.get('error', 'Unknown error'))
         
-        logger.info(f"Deduplicated: {len(all_orders)} -> {len(deduped_orders)} orders")
+        deduped_orders = list(unique_orders.values())
         
-        # Ordenar cronológicamente (más reciente primero)
-        def get_timestamp(order):
-            return int(order.get('ctime') or order.get('cTime') or 
-                      order.get('timestamp') or order.get('createTime') or 0)
+        logger.info("Deduplicated: %s -> %s orders", received_orders, len(deduped_orders))
         
-        deduped_orders.sort(key=get_timestamp, reverse=True)
+        # Ordenar cronológicamente (más reciente primero)
+        deduped_orders = _sort_newest_first(deduped_orders)
         
         # Calcular duración total
         duration_seconds = time.time() - start_time_collector
@@ -105,7 +156,7 @@ def lambda_handler(event, context):
             "processed_symbols": processed_symbols,
             "failed_symbols": failed_symbols,
             "processing_stats": processing_stats,
-            "execution_timestamp": int(time.time() * 1000),
+            "execution_timestamp": time.time_ns() // 1_000_000,
             "metadata": {
                 "total_symbols_attempted": len(event),
                 "avg_orders_per_symbol": round(len(deduped_orders) / max(processed_symbols, 1), 2),
@@ -115,11 +166,16 @@ def lambda_handler(event, context):
         
         # Guardar resultado en S3
         s3_location = save_to_s3(final_result)
-        final_result['s3_location'] = s3_location
         
-        logger.info(f"Collector completed: {len(deduped_orders)} total orders from {processed_symbols} symbols")
-        logger.info(f"Result saved to: {s3_location}")
+        logger.info("Collector completed: %s total orders from %s symbols", len(deduped_orders), processed_symbols)
+        logger.info("Result saved to: %s", s3_location)
         
+        # Las órdenes solo van en el archivo: la salida de un estado no puede superar 256 KiB
+        del final_result['data']
+        final_result['s3_location'] = s3_location
+        if s3_location is None:
+            final_result['success'] = False
+            final_result['error'] = "Could not save the result to S3"
         return final_result
         
     except Exception as e:
@@ -129,25 +185,18 @@ def lambda_handler(event, context):
         
         return {
             "success": False,
-            "data": [],
             "duration_seconds": round(duration_seconds, 2),
             "total_orders": 0,
             "processed_symbols": 0,
             "failed_symbols": len(event) if isinstance(event, list) else 1,
+            "s3_location": None,
             "error": str(e)
         }
 
 def save_to_s3(result_data):
-    """Guarda el resultado en S3 y retorna la ubicación"""
+    """Guarda el resultado en S3 y retorna la ubicación (None si falla)"""
     try:
-        # Cliente S3 para LocalStack
-        s3_client = boto3.client(
-            's3',
-            region_name=os.environ.get('AWS_REGION', 'us-east-1'),
-            aws_access_key_id=os.environ.get('AWS_ACCESS_KEY_ID', 'test'),
-            aws_secret_access_key=os.environ.get('AWS_SECRET_ACCESS_KEY', 'test'),
-            endpoint_url=os.environ.get('S3_ENDPOINT_URL', 'http://localhost:4566')
-        )
+        s3_client = _s3()
         
         bucket_name = 'bitget-results'
         
@@ -155,28 +204,60 @@ def save_to_s3(result_data):
         try:
             s3_client.head_bucket(Bucket=bucket_name)
         except:
-            logger.info(f"Creating bucket {bucket_name}")
+            logger.info("Creating bucket %s", bucket_name)
             s3_client.create_bucket(Bucket=bucket_name)
         
         # Generar nombre de archivo único
         timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
-        filename = f"futures_orders_{timestamp}.json"
         
-        # Guardar archivo
-        json_content = json.dumps(result_data, indent=2, default=str)
+        if NDJSON_OUTPUT:
+            filename = f"futures_orders_{timestamp}.ndjson.gz"
+            
+            # Metadatos aparte; las órdenes se comprimen línea a línea sin armar el JSON completo
+            s3_client.put_object(
+                Bucket=bucket_name,
+                Key=f"futures_orders_{timestamp}_meta.json",
+                Body=orjson.dumps({k: v for k, v in result_data.items() if k != 'data'}, default=str),
+                ContentType='application/json'
+            )
+            body = tempfile.SpooledTemporaryFile(max_size=SPOOL_MAX_SIZE)
+            with gzip.GzipFile(fileobj=body, mode='wb', compresslevel=1) as gz:
+                for order in result_data.get('data', []):
+                    gz.write(orjson.dumps(order, default=str))
+                    gz.write(b"\n")
+            body.seek(0)
+            content_type = 'application/x-ndjson'
+        else:
+            filename = f"futures_orders_{timestamp}.json.gz"
+            
+            # Guardar archivo: JSON compacto comprimido con gzip (nivel 1, prioriza CPU)
+            json_content = orjson.dumps(result_data, default=str)
+            body = io.BytesIO(gzip.compress(json_content, compresslevel=1))
+            content_type = 'application/json'
         
-        s3_client.put_object(
-            Bucket=bucket_name,
-            Key=filename,
-            Body=json_content.encode('utf-8'),
-            ContentType='application/json'
-        )
+        with body:
+            s3_client.upload_fileobj(
+                body,
+                bucket_name,
+                filename,
+                ExtraArgs={'ContentType': content_type, 'ContentEncoding': 'gzip'},
+                Config=_TRANSFER_CONFIG
+            )
+        
+        # Copia legible sin comprimir solo para depurar
+        if os.environ.get('SAVE_PRETTY_JSON', 'false').lower() in ('1', 'true'):
+            s3_client.put_object(
+                Bucket=bucket_name,
+                Key=f"futures_orders_{timestamp}_pretty.json",
+                Body=orjson.dumps(result_data, option=orjson.OPT_INDENT_2, default=str),
+                ContentType='application/json'
+            )
         
         s3_location = f"s3://{bucket_name}/{filename}"
-        logger.info(f"Successfully saved result to {s3_location}")
+        logger.info("Successfully saved result to %s", s3_location)
         
         return s3_location
         
     except Exception as e:
-        logger.error(f"Error saving to S3: {str(e)}")
-        return f"Error saving to S3: {str(e)}"
\ No newline at end of file
+        logger.error("Error saving to S3: %s", e)
+        return None
\ No newline at end of file
@@ -1,18 +1,57 @@
-import json
+import orjson
 import logging
 import os
-import sys
 import time
 
-# Add lambdas directory to path for imports
-sys.path.append('/opt/python')
-sys.path.append(os.path.join(os.path.dirname(os.path.dirname(__file__))))
-
-from bitget_client import BitgetClient
+# En Lambda bitget_client llega por el Layer (/opt/python ya está en sys.path);
+# en local se importa como paquete desde la raíz del repo, igual que en el worker
+try:
+    from bitget_client import BitgetClient
+except ImportError:
+    from lambdas.bitget_client import BitgetClient
 
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 
+# Rango por defecto: 30 días = 30 * 24 * 60 * 60 * 1000 ms
+MS_PER_30D = 30 * 86_400_000
+
+# Cliente Bitget creado una sola vez por contenedor (reutiliza conexiones en invocaciones "warm")
+_CLIENT = None
+
+def _client() -> BitgetClient:
+    """Bitget client built lazily on first use (missing credentials fail inside the handler)"""
+    global _CLIENT
+    if _CLIENT is None:
+        _CLIENT = BitgetClient(
+            api_key=os.environ['BITGET_API_KEY'],
+            secret_key=os.environ['BITGET_SECRET_KEY'],
+            passphrase=os.environ['BITGET_PASSPHRASE']
+        )
+    return _CLIENT
+
+# Cache de la lista de símbolos en /tmp (se conserva entre invocaciones del mismo contenedor)
+SYMBOLS_CACHE_PATH = '/tmp/symbols.json'
+SYMBOLS_CACHE_TTL = int(os.environ.get('SYMBOLS_CACHE_TTL', '3600'))
+
+def _cached_symbols(client, ttl=SYMBOLS_CACHE_TTL):
+    """Futures symbol list, cached in /tmp for ttl seconds"""
+    try:
+        if time.time() - os.path.getmtime(SYMBOLS_CACHE_PATH) < ttl:
+            with open(SYMBOLS_CACHE_PATH, 'rb') as f:
+                return orjson.loads(f.read())
+    except (OSError, ValueError):
+        pass
+    
+    symbols = client.get_futures_symbols()
+    if symbols:
+        # Escritura atómica: otro proceso nunca lee un archivo a medias
+        tmp_path = f"{SYMBOLS_CACHE_PATH}.{os.getpid()}"
+        with open(tmp_path, 'wb') as f:
+            f.write(orjson.dumps(symbols))
+        os.replace(tmp_path, SYMBOLS_CACHE_PATH)
+    return symbols
+
 def lambda_handler(event, context):
     """
     Lambda coordinador que obtiene todos los símbolos de futures y prepara la ejecución en paralelo
@@ -34,25 +73,22 @@ def lambda_handler(event, context):
     """
     
     try:
-        logger.info(f"Coordinator received event: {json.dumps(event)}")
-        
-        # Inicializar cliente Bitget
-        client = BitgetClient(
-            api_key=os.environ['BITGET_API_KEY'],
-            secret_key=os.environ['BITGET_SECRET_KEY'],
-            passphrase=os.environ['BITGET_PASSPHRASE']
-        )
+        logger.info("Coordinator received event keys=%s symbols=%d",
+                    list(event.keys()), len(event.get('symbols') or []))
+        # El evento completo (puede traer cientos de símbolos) solo en DEBUG
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("Coordinator event: %s", orjson.dumps(event).decode())
         
         # Obtener símbolos
         if 'symbols' in event and event['symbols']:
             # Usar símbolos proporcionados
             symbols = event['symbols']
-            logger.info(f"Using provided symbols: {len(symbols)} symbols")
+            logger.info("Using provided symbols: %s symbols", len(symbols))
         else:
             # Obtener todos los símbolos de futures activos
             logger.info("Fetching all active futures symbols...")
-            symbols = client.get_futures_symbols()
-            logger.info(f"Retrieved {len(symbols)} active futures symbols")
+            symbols = _cached_symbols(_client())
+            logger.info("Retrieved %s active futures symbols", len(symbols))
         
         if not symbols:
             raise Exception("No symbols found or provided")
@@ -61,20 +97,22 @@ def lambda_handler(event, context):
         start_time = event.get('startTime')
         end_time = event.get('endTime')
         
+        # Milisegundos en aritmética entera (sin pasar por float)
+        now_ms = time.time_ns() // 1_000_000
+        
         # Si no se proporciona startTime, usar 30 días atrás por defecto
         if not start_time:
-            # 30 días = 30 * 24 * 60 * 60 * 1000 ms
-            start_time = int((time.time() - (30 * 24 * 60 * 60)) * 1000)
+            start_time = now_ms - MS_PER_30D
         
         result = {
             "symbols": symbols,
             "startTime": start_time,
             "endTime": end_time,
             "totalSymbols": len(symbols),
-            "coordinatorTimestamp": int(time.time() * 1000)
+            "coordinatorTimestamp": now_ms
         }
         
-        logger.info(f"Coordinator result: {len(symbols)} symbols prepared for parallel processing")
+        logger.info("Coordinator result: %s symbols prepared for parallel processing", len(symbols))
         
         return {
             'statusCode': 200,
@@ -82,7 +120,7 @@ def lambda_handler(event, context):
         }
         
     except Exception as e:
-        logger.error(f"Error in coordinator: {str(e)}", exc_info=True)
+        logger.error("Error in coordinator: %s", e, exc_info=True)
         return {
             'statusCode': 500,
             'body': {
@@ -1,13 +1,159 @@
-import json
+import functools
+import orjson
 import logging
 import os
+import gzip
+import tempfile
 import time
-from typing import List, Dict, Optional
+import boto3
+from boto3.s3.transfer import TransferConfig
+from botocore.config import Config
+from botocore.exceptions import ClientError
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Dict, Optional, Tuple
 from lambdas.bitget_client import BitgetClient
 
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 
+# Símbolos descargados a la vez dentro de un worker (acotado por el rate limit de Bitget)
+WORKER_CONCURRENCY = int(os.environ.get('WORKER_CONCURRENCY', '10'))
+
+# Con RESULT_BUCKET todas las órdenes van a S3 y por Step Functions solo viaja el puntero:
+# el Map junta la salida de todos los workers y un estado no puede superar 256 KiB
+RESULT_BUCKET = os.environ.get('RESULT_BUCKET')
+# Subida multiparte en partes de 8 MB; el archivo temporal pasa a disco a partir de 16 MB
+_TRANSFER_CONFIG = TransferConfig(multipart_threshold=8 * 1024 * 1024, use_threads=True)
+SPOOL_MAX_SIZE = 16 * 1024 * 1024
+
+_S3 = None
+
+def _s3():
+    """S3 client for result offload, built lazily on first use"""
+    global _S3
+    if _S3 is None:
+        _S3 = boto3.client(
+            's3',
+            region_name=os.environ.get('AWS_REGION', 'us-east-1'),
+            aws_access_key_id=os.environ.get('AWS_ACCESS_KEY_ID', 'test'),
+            aws_secret_access_key=os.environ.get('AWS_SECRET_ACCESS_KEY', 'test'),
+            endpoint_url=os.environ.get('S3_ENDPOINT_URL', 'http://localhost:4566'),
+            config=Config(max_pool_connections=32)
+        )
+    return _S3
+
+@functools.lru_cache(maxsize=None)
+def _ensure_bucket(bucket_name: str) -> None:
+    """Create the bucket if it doesn't exist (checked once per container)"""
+    try:
+        _s3().head_bucket(Bucket=bucket_name)
+    except ClientError:
+        logger.info("Creating bucket %s", bucket_name)
+        _s3().create_bucket(Bucket=bucket_name)
+
+class OrderSink:
+    """Collects a worker's orders; with RESULT_BUCKET set they are streamed to S3 as gzipped NDJSON"""
+
+    def __init__(self, worker_id: str):
+        self.worker_id = worker_id
+        self.count = 0
+        self.size = 0
+        self.orders: List[Dict] = []
+        self.file = None
+        self.gz = None
+        if RESULT_BUCKET:
+            # Comprime línea a línea a un archivo temporal que pasa a /tmp si crece mucho
+            self.file = tempfile.SpooledTemporaryFile(max_size=SPOOL_MAX_SIZE)
+            self.gz = gzip.GzipFile(fileobj=self.file, mode='wb', compresslevel=1)
+
+    def write(self, orders: List[Dict]) -> None:
+        self.count += len(orders)
+        if self.gz is None:
+            self.orders.extend(orders)
+            return
+        for order in orders:
+            line = orjson.dumps(order)
+            self.gz.write(line)
+            self.gz.write(b"\n")
+            self.size += len(line) + 1
+
+    def finish(self) -> Tuple[List[Dict], Optional[Dict]]:
+        """Return (inline orders, S3 pointer); the orders come back inline if the upload fails"""
+        if self.gz is None:
+            return self.orders, None
+        self.gz.close()
+        with self.file:
+            if not self.count:
+                return [], None
+            key = f"worker/{self.worker_id}/{time.time_ns() // 1_000_000}.ndjson.gz"
+            self.file.seek(0)
+            try:
+                _ensure_bucket(RESULT_BUCKET)
+                _s3().upload_fileobj(
+                    self.file,
+                    RESULT_BUCKET,
+                    key,
+                    ExtraArgs={'ContentType': 'application/x-ndjson', 'ContentEncoding': 'gzip'},
+                    Config=_TRANSFER_CONFIG
+                )
+            except Exception as e:
+                # Mejor una respuesta grande que perder las órdenes del worker
+                logger.error("Worker %s could not offload to s3://%s: %s; returning orders inline",
+                             self.worker_id, RESULT_BUCKET, e)
+                self.file.seek(0)
+                with gzip.GzipFile(fileobj=self.file, mode='rb') as body:
+                    return [orjson.loads(line) for line in body if line.strip()], None
+        logger.info("Worker %s offloaded %s items (%s bytes) to s3://%s/%s",
+                    self.worker_id, self.count, self.size, RESULT_BUCKET, key)
+        return [], {"s3_bucket": RESULT_BUCKET, "s3_key": key, "count": self.count, "format": "ndjson"}
+
+# Cliente Bitget creado una sola vez por contenedor (reutiliza conexiones en invocaciones "warm")
+_CLIENT = None
+
+def _client() -> BitgetClient:
+    """Bitget client built lazily on first use"""
+    global _CLIENT
+    if _CLIENT is None:
+        _CLIENT = BitgetClient(
+            api_key=os.environ.get('BITGET_API_KEY'),
+            secret_key=os.environ.get('BITGET_SECRET_KEY'),
+            passphrase=os.environ.get('BITGET_PASSPHRASE')
+        )
+    return _CLIENT
+
+def _key(order: Dict) -> tuple:
+    """Unique key for an order or fill based on several fields"""
+    return (order.get('symbol'),
+            order.get('orderId') or order.get('tradeId') or order.get('fillId') or order.get('id'),
+            order.get('cTime') or order.get('timestamp'))
+
+def _process_symbol(client: BitgetClient, symbol: str, start_time: Optional[int],
+                    end_time: Optional[int], use_fills: bool,
+                    worker_id: str) -> Tuple[str, List[Dict], float, Optional[str]]:
+    """Fetch one symbol; returns (symbol, orders, elapsed, error)"""
+    symbol_start = time.time()
+    try:
+        logger.info("Worker %s processing symbol %s", worker_id, symbol)
+        
+        # Obtener órdenes/fills para el símbolo
+        orders = BitgetClient.fetch_all_futures_history_for_symbol(
+            client=client,
+            symbol=symbol,
+            start_time=start_time,
+            end_time=end_time,
+            per_page=100,
+            use_fills=use_fills
+        )
+        
+        processing_time = time.time() - symbol_start
+        logger.info("Worker %s - %s: %s items in %.2fs", worker_id, symbol, len(orders), processing_time)
+        return symbol, orders, processing_time, None
+        
+    except Exception as e:
+        processing_time = time.time() - symbol_start
+        logger.error("Error processing %s: %s", symbol, e)
+        return symbol, [], processing_time, str(e)
+
 def lambda_handler(event, context):
     """
     Lambda worker que procesa un batch de símbolos en paralelo
@@ -27,7 +173,8 @@ def lambda_handler(event, context):
         "worker_id": "worker-001",
         "processed_symbols": 25,
         "total_orders": 1247,
-        "orders": [...],  # Todas las órdenes/fills
+        "orders": [...],  # Todas las órdenes/fills ([] si se subieron a S3)
+        "result_s3": {"s3_bucket": ..., "s3_key": ..., "count": 1247},  # o null
         "processing_time": 45.2,
         "failed_symbols": ["SYMBOL1"],
         "symbol_stats": {
@@ -42,7 +189,7 @@ def lambda_handler(event, context):
     worker_id = event.get('worker_id', f'worker-{int(time.time())}')
     
     try:
-        logger.info(f"Worker {worker_id} starting processing...")
+        logger.info("Worker %s starting processing...", worker_id)
         
         # Extraer parámetros
         symbols = event.get('symbols', [])
@@ -58,97 +205,71 @@ def lambda_handler(event, context):
                 "processed_symbols": 0,
                 "total_orders": 0,
                 "orders": [],
+                "result_s3": None,
                 "processing_time": 0
             }
         
-        logger.info(f"Worker {worker_id} processing {len(symbols)} symbols with use_fills={use_fills}")
+        logger.info("Worker %s processing %s symbols with use_fills=%s", worker_id, len(symbols), use_fills)
         
-        # Inicializar cliente Bitget
-        client = BitgetClient(
-            api_key=os.environ.get('BITGET_API_KEY'),
-            secret_key=os.environ.get('BITGET_SECRET_KEY'),
-            passphrase=os.environ.get('BITGET_PASSPHRASE')
-        )
+        client = _client()
         
-        all_orders = []
+        # La clave de dedup incluye el símbolo: basta con deduplicar cada símbolo por separado
+        symbols = list(dict.fromkeys(symbols))
+        sink = OrderSink(worker_id)
+        data_type = 'fill' if use_fills else 'order'
         failed_symbols = []
         symbol_stats = {}
         
-        # Procesar cada símbolo secuencialmente (el paralelismo está a nivel de workers)
-        for symbol in symbols:
-            symbol_start = time.time()
-            try:
-                logger.info(f"Worker {worker_id} processing symbol {symbol}")
+        # Símbolos en paralelo: cada descarga pasa casi todo el tiempo esperando la red.
+        # Todos los hilos comparten el cliente (y su pool de conexiones).
+        max_workers = max(1, min(WORKER_CONCURRENCY, len(symbols)))
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            results = executor.map(
+                lambda symbol: _process_symbol(client, symbol, start_time, end_time, use_fills, worker_id),
+                symbols
+            )
+            for symbol, orders, processing_time, error in results:
+                if error is not None:
+                    failed_symbols.append(symbol)
+                    symbol_stats[symbol] = {
+                        "orders": 0,
+                        "time": round(processing_time, 2),
+                        "error": error
+                    }
+                    continue
                 
-                # Obtener órdenes/fills para el símbolo
-                orders = BitgetClient.fetch_all_futures_history_for_symbol(
-                    client=client,
-                    symbol=symbol,
-                    start_time=start_time,
-                    end_time=end_time,
-                    per_page=100,
-                    sleep_between=0.12,
-                    use_fills=use_fills
-                )
-                
-                # Asegurar que cada orden tenga el símbolo
+                # Etiquetar y deduplicar en la misma pasada (sin lista intermedia)
+                deduped = {}
                 for order in orders:
                     order['symbol'] = symbol
                     order['worker_id'] = worker_id
-                    order['data_type'] = 'fill' if use_fills else 'order'
-                
-                all_orders.extend(orders)
-                
-                processing_time = time.time() - symbol_start
+                    order['data_type'] = data_type
+                    deduped.setdefault(_key(order), order)
+                sink.write(list(deduped.values()))
                 symbol_stats[symbol] = {
                     "orders": len(orders),
                     "time": round(processing_time, 2)
                 }
-                
-                logger.info(f"Worker {worker_id} - {symbol}: {len(orders)} items in {processing_time:.2f}s")
-                
-            except Exception as e:
-                processing_time = time.time() - symbol_start
-                error_msg = f"Error processing {symbol}: {str(e)}"
-                logger.error(error_msg)
-                
-                failed_symbols.append(symbol)
-                symbol_stats[symbol] = {
-                    "orders": 0,
-                    "time": round(processing_time, 2),
-                    "error": str(e)
-                }
         
-        # Deduplicar dentro del worker
-        seen = set()
-        deduped_orders = []
-        for order in all_orders:
-            # Crear clave única basada en múltiples campos
-            order_id = (order.get('orderId') or order.get('tradeId') or 
-                       order.get('fillId') or order.get('id'))
-            symbol = order.get('symbol')
-            timestamp = order.get('cTime') or order.get('timestamp')
-            
-            key = (symbol, order_id, timestamp)
-            if key not in seen:
-                seen.add(key)
-                deduped_orders.append(order)
+        # Se conserva la primera aparición de cada clave
+        deduped_orders, result_s3 = sink.finish()
         
         total_processing_time = time.time() - start_time_worker
         
-        logger.info(f"Worker {worker_id} completed: {len(deduped_orders)} unique items from {len(symbols)} symbols")
+        logger.info("Worker %s completed: %s unique items from %s symbols", worker_id, sink.count, len(symbols))
         
         return {
             "success": True,
             "worker_id": worker_id,
             "processed_symbols": len(symbols),
             "failed_symbols": failed_symbols,
-            "total_orders": len(deduped_orders),
+            "total_orders": sink.count,
             "orders": deduped_orders,
+            "result_s3": result_s3,
             "processing_time": round(total_processing_time, 2),
             "symbol_stats": symbol_stats,
             "use_fills": use_fills,
-            "execution_timestamp": int(time.time() * 1000)
+            "execution_timestamp": time.time_ns() // 1_000_000
         }
         
     except Exception as e:
@@ -163,5 +284,6 @@ def lambda_handler(event, context):
             "processed_symbols": 0,
             "total_orders": 0,
             "orders": [],
+            "result_s3": None,
             "processing_time": round(total_processing_time, 2)
         }
\ No newline at end of file